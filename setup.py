@@ -20,9 +20,10 @@ setuptools.setup(
     project_urls={
         "Documentation": "https://sit2standpy.readthedocs.io/en/latest/"
     },
-    include_pacakge_data=True,
+    include_package_data=True,
     package_data={'sit2standpy': ['data/**']},
     packages=setuptools.find_packages(),
+    zip_safe=False,  # numba caches compiled functions alongside the modules
     license='MIT',
     python_requires='>=3.7',
     install_requires=[
@@ -30,6 +31,7 @@ setuptools.setup(
         'scipy',
         'pandas',
         'pywavelets',
+        'numba>=0.56',
         'udatetime'
     ],
     classifiers=[
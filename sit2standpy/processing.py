@@ -5,25 +5,387 @@ Lukas Adamowicz
 Pfizer
 2019
 """
-from numpy import around, mean, diff, timedelta64, arange, logical_and, sum, std, argwhere, append, insert, \
-    ascontiguousarray
-from numpy.linalg import norm
-from scipy.signal import butter, filtfilt, find_peaks
+from numpy import around, diff, timedelta64, arange, logical_and, sum, std, flatnonzero, append, insert, \
+    ascontiguousarray, asarray, empty, sqrt, floor, ndarray, float32, float64, dtype as np_dtype, array, cumsum, \
+    concatenate, unique, isfinite, where, datetime64, nan
+from scipy.signal import butter, find_peaks
 import pywt
-from pandas import to_datetime
+from numba import njit, prange
+from pandas import to_datetime, DatetimeIndex, Timedelta, date_range
 from udatetime import utcfromtimestamp
 from warnings import warn
+from functools import lru_cache
+from datetime import time, datetime
 
-from sit2standpy.utility import mov_stats
+from sit2standpy.utility import mov_stats_nb
 
 
 __all__ = ['AccelerationFilter', 'process_timestamps']
 
+# time of day formats accepted by pandas.DatetimeIndex.indexer_between_time
+_TIME_FORMATS = ['%H:%M', '%H%M', '%I:%M%p', '%I%M%p', '%H:%M:%S', '%H%M%S', '%I:%M:%S%p', '%I%M%S%p']
+
+# unix timestamp units per second
+_UNITS_PER_S = {'s': 1., 'ms': 1e3, 'us': 1e6, 'ns': 1e9}
+
+
+@lru_cache(maxsize=32)
+def _design_butter(order, cutoff_hz, fs):
+    """
+    Design (and cache) a low-pass Butterworth filter as second-order sections.
+
+    Parameters
+    ----------
+    order : int
+        Filter order.
+    cutoff_hz : float
+        Filter cutoff frequency, in Hz.
+    fs : float
+        Sampling frequency, in Hz.
+
+    Returns
+    -------
+    sos : numpy.ndarray
+        Read-only array of second-order filter coefficients.
+    """
+    sos = butter(order, 2 * cutoff_hz / fs, btype='low', output='sos')
+    sos.flags.writeable = False  # the same array is returned for every call with these parameters
+    return sos
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def _mag3_soa(ax, ay, az, out):
+    """
+    Compute the magnitude of 3 axes of data stored in separate arrays in a single pass.
+
+    Parameters
+    ----------
+    ax, ay, az : numpy.ndarray
+        (N, ) contiguous arrays of data for each axis.
+    out : numpy.ndarray
+        (N, ) array to store the magnitude in.
+
+    Returns
+    -------
+    mag : numpy.ndarray
+        `out`, the magnitude.
+    """
+    for i in prange(ax.size):
+        out[i] = sqrt(ax[i] * ax[i] + ay[i] * ay[i] + az[i] * az[i])
+    return out
+
+
+@njit(cache=True)
+def _sos_padlen(sos):
+    """
+    Signal extension length used when forward-backward filtering with second-order sections, following
+    `scipy.signal.sosfiltfilt`.
+    """
+    n_sec = sos.shape[0]
+    n_zb, n_za = 0, 0
+    for s in range(n_sec):
+        if sos[s, 2] == 0.0:
+            n_zb += 1
+        if sos[s, 5] == 0.0:
+            n_za += 1
+    return 3 * (2 * n_sec + 1 - min(n_zb, n_za))
+
+
+@njit(cache=True)
+def _sos_init(sos):
+    """
+    Normalize the second-order sections, and compute their steady-state step response initial conditions.
+
+    Parameters
+    ----------
+    sos : numpy.ndarray
+        (n_sections, 6) array of second-order filter coefficients.
+
+    Returns
+    -------
+    coef : numpy.ndarray
+        (n_sections, 5) array of the normalized coefficients (b0, b1, b2, a1, a2) of each section.
+    zi : numpy.ndarray
+        (n_sections, 2) array of the initial conditions (`scipy.signal.sosfilt_zi`), solved in closed form for each
+        section.
+    """
+    n_sec = sos.shape[0]
+
+    coef = empty((n_sec, 5))
+    zi = empty((n_sec, 2))
+    scale = 1.0
+    for s in range(n_sec):
+        for k in range(3):
+            coef[s, k] = sos[s, k] / sos[s, 3]
+        coef[s, 3] = sos[s, 4] / sos[s, 3]
+        coef[s, 4] = sos[s, 5] / sos[s, 3]
+
+        b0, b1, b2, a1, a2 = coef[s, 0], coef[s, 1], coef[s, 2], coef[s, 3], coef[s, 4]
+        z1 = (b1 - a1 * b0 + b2 - a2 * b0) / (1.0 + a1 + a2)
+        zi[s, 0] = scale * z1
+        zi[s, 1] = scale * (b2 - a2 * b0 - a2 * z1)
+        scale *= (b0 + b1 + b2) / (1.0 + a1 + a2)
+    return coef, zi
+
+
+@njit(cache=True, fastmath=True)
+def _sos_step(coef, z, xi):
+    """
+    Filter one sample through all the cascaded second-order sections, updating the (n_sections, 2) section state
+    `z` in place, and returning the filtered sample.
+    """
+    for s in range(coef.shape[0]):
+        yi = coef[s, 0] * xi + z[s, 0]
+        z[s, 0] = coef[s, 1] * xi - coef[s, 3] * yi + z[s, 1]
+        z[s, 1] = coef[s, 2] * xi - coef[s, 4] * yi
+        xi = yi
+    return xi
+
+
+@njit(cache=True, fastmath=True)
+def _filtfilt_backward(coef, zi, ext, pad, n, out):
+    """
+    Backward pass of forward-backward filtering, over the forward filtered extended signal in `ext`, storing only
+    the N samples of the signal itself in `out`.
+    """
+    m = n + 2 * pad
+    z = zi * ext[m - 1]
+    for i in range(m - 1, pad + n - 1, -1):
+        _sos_step(coef, z, ext[i])
+    for i in range(pad + n - 1, pad - 1, -1):
+        out[i - pad] = _sos_step(coef, z, ext[i])
+    return out
+
+
+@njit(cache=True)
+def _check_ext(sos, n, ext):
+    """
+    Check the signal and work array lengths for forward-backward filtering, returning the padding length.
+    """
+    pad = _sos_padlen(sos)
+    if n <= pad:
+        raise ValueError('The length of the input vector must be greater than the filter padding length.')
+    if ext.size < n + 2 * pad:
+        raise ValueError('The work array is too small for the extended signal.')
+    return pad
+
+
+@njit(cache=True, fastmath=True)
+def _sosfiltfilt_into(sos, x, ext, out):
+    """
+    Forward-backward filtering with second-order sections into pre-allocated arrays. See `sosfiltfilt_nb`.
+
+    Each direction is a single pass over the data, with every sample run through all the sections in turn. The
+    odd extension of the signal at both ends is computed as it is filtered.
+
+    Parameters
+    ----------
+    sos : numpy.ndarray
+        (n_sections, 6) array of second-order filter coefficients.
+    x : numpy.ndarray
+        (N, ) array of data to filter.
+    ext : numpy.ndarray
+        Work array of at least N + 2 * `_sos_padlen(sos)` samples, used for the forward filtered extended signal.
+    out : numpy.ndarray
+        (N, ) array to store the filtered data in.
+
+    Returns
+    -------
+    y : numpy.ndarray
+        `out`, the filtered data.
+    """
+    n = x.size
+    pad = _check_ext(sos, n, ext)
+    coef, zi = _sos_init(sos)
+
+    # forward pass, over the odd extension at the start, the signal, and the odd extension at the end
+    x0, xn = x[0], x[n - 1]
+    z = zi * (2.0 * x0 - x[pad])
+    for i in range(pad):
+        ext[i] = _sos_step(coef, z, 2.0 * x0 - x[pad - i])
+    for i in range(n):
+        ext[pad + i] = _sos_step(coef, z, x[i])
+    for i in range(pad):
+        ext[pad + n + i] = _sos_step(coef, z, 2.0 * xn - x[n - 2 - i])
+
+    return _filtfilt_backward(coef, zi, ext, pad, n, out)
+
+
+@njit(cache=True, fastmath=True)
+def _mag3(a, i):
+    """
+    Magnitude of row `i` of (N, 3) data.
+    """
+    return sqrt(a[i, 0]**2 + a[i, 1]**2 + a[i, 2]**2)
+
+
+@njit(cache=True, fastmath=True)
+def _mag_sosfiltfilt_into(sos, a, ext, out):
+    """
+    Compute the magnitude of (N, 3) data and forward-backward filter it with second-order sections. The magnitude is
+    computed as it is filtered in the forward pass, so it is never stored as a separate intermediate array.
+
+    Parameters
+    ----------
+    sos : numpy.ndarray
+        (n_sections, 6) array of second-order filter coefficients.
+    a : numpy.ndarray
+        (N, 3) C-contiguous array of data.
+    ext : numpy.ndarray
+        Work array of at least N + 2 * `_sos_padlen(sos)` samples, used for the forward filtered extended signal.
+    out : numpy.ndarray
+        (N, ) array to store the filtered magnitude in.
+
+    Returns
+    -------
+    y : numpy.ndarray
+        `out`, the filtered magnitude.
+    """
+    n = a.shape[0]
+    pad = _check_ext(sos, n, ext)
+    coef, zi = _sos_init(sos)
+
+    # forward pass, over the odd extension at the start, the magnitude, and the odd extension at the end
+    m0, mn = _mag3(a, 0), _mag3(a, n - 1)
+    z = zi * (2.0 * m0 - _mag3(a, pad))
+    for i in range(pad):
+        ext[i] = _sos_step(coef, z, 2.0 * m0 - _mag3(a, pad - i))
+    for i in range(n):
+        ext[pad + i] = _sos_step(coef, z, _mag3(a, i))
+    for i in range(pad):
+        ext[pad + n + i] = _sos_step(coef, z, 2.0 * mn - _mag3(a, n - 2 - i))
+
+    return _filtfilt_backward(coef, zi, ext, pad, n, out)
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def _batch_mag_sosfiltfilt(sos, accel, offsets, ext, out):
+    """
+    Compute the magnitude and forward-backward filter multiple segments of (N, 3) data flattened into one array,
+    processing the segments in parallel.
+
+    Parameters
+    ----------
+    sos : numpy.ndarray
+        (n_sections, 6) array of second-order filter coefficients.
+    accel : numpy.ndarray
+        (N, 3) C-contiguous array of the data for all the segments.
+    offsets : numpy.ndarray
+        (n_segments + 1, ) array of the start index of each segment in `accel`, ending with N.
+    ext : numpy.ndarray
+        Work array of at least N + 2 * n_segments * `_sos_padlen(sos)` samples, for the extended signals.
+    out : numpy.ndarray
+        (N, ) array to store the filtered magnitude in.
+
+    Returns
+    -------
+    y : numpy.ndarray
+        `out`, the filtered magnitude of all the segments.
+    """
+    pad = _sos_padlen(sos)
+    for s in prange(offsets.size - 1):
+        i1, i2 = offsets[s], offsets[s + 1]
+        # each segment's extended signal is offset by the padding of all the previous segments
+        _mag_sosfiltfilt_into(sos, accel[i1:i2], ext[i1 + 2 * pad * s:i2 + 2 * pad * (s + 1)], out[i1:i2])
+    return out
+
+
+@njit(cache=True)
+def sosfiltfilt_nb(sos, x):
+    """
+    Forward-backward filtering of a signal using cascaded second-order sections, compiled with Numba.
+
+    Equivalent to `scipy.signal.sosfiltfilt` with the default odd signal extension, but filters in a single
+    streaming pass per direction, running each sample through all the sections before moving on to the next. Only
+    the forward filtered extended signal is stored between the two passes.
+
+    Parameters
+    ----------
+    sos : numpy.ndarray
+        (n_sections, 6) array of second-order filter coefficients, as returned by
+        `scipy.signal.butter(..., output='sos')`.
+    x : numpy.ndarray
+        (N, ) array of floating point data to filter. The output, and the buffer used while filtering, have the same
+        precision as `x`, while the filter arithmetic is always done in double precision.
+
+    Returns
+    -------
+    y : numpy.ndarray
+        (N, ) array of the filtered data.
+    """
+    ext = empty(x.size + 2 * _sos_padlen(sos), x.dtype)
+    return _sosfiltfilt_into(sos, x, ext, empty(x.size, x.dtype))
+
+
+def _dwt_reconstruct(x, wavelet, mode, recon_level):
+    """
+    Reconstruct a signal from only its DWT approximation coefficients at the deepest level and its detail
+    coefficients at the desired level, with all other detail levels treated as 0s.
+
+    Equivalent to zeroing the other detail levels of `pywt.wavedec` and reconstructing with `pywt.waverec`, but
+    without computing, allocating, or filtering any of the zeroed coefficients.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        (N, ) array of data.
+    wavelet : {str, pywt.Wavelet}
+        Discrete wavelet to use.
+    mode : str
+        Signal extension mode.
+    recon_level : int
+        Level of the detail coefficients to keep, with 1 being the finest.
+
+    Returns
+    -------
+    x_r : numpy.ndarray
+        (N, ) array of the reconstructed signal.
+    """
+    wave = wavelet if isinstance(wavelet, pywt.Wavelet) else pywt.Wavelet(wavelet)
+    max_level = pywt.dwt_max_level(x.size, wave)
+
+    # only the approximation and the desired level of detail coefficients are kept
+    if (max_level + 1 - recon_level) < 1:
+        warn(UserWarning(f'Chosen reconstruction level is too high, '
+                         f'setting reconstruction level to {max_level}'))
+        level = max_level
+    else:
+        level = recon_level
+
+    # coefficient lengths at each level of the decomposition
+    sizes = [x.size]
+    for _ in range(max_level):
+        sizes.append(pywt.dwt_coeff_len(sizes[-1], wave.dec_len, mode))
+
+    # deconstruct the signal, computing only the kept coefficients instead of the full decomposition
+    if 0 < level == max_level:
+        # both sets of coefficients are from the deepest level, so come from a single level transform of the
+        # approximation at the level above
+        if max_level > 1:
+            c_a = pywt.downcoef('a', x, wave, mode=mode, level=max_level - 1)
+        else:
+            c_a = x
+        c_a, c_d = pywt.dwt(c_a, wave, mode=mode)
+    else:
+        c_a = pywt.downcoef('a', x, wave, mode=mode, level=max_level) if max_level > 0 else x
+        c_d = pywt.downcoef('d', x, wave, mode=mode, level=level) if level > 0 else None
+
+    # reconstruct level by level. Zeroed detail levels are passed as None, which pywt.idwt treats as all 0s
+    # without needing them to be allocated and filled. The approximation is trimmed to the size of the next
+    # level, as pywt.waverec would do
+    x_r = c_a
+    for i in range(max_level, 0, -1):
+        x_r = pywt.idwt(x_r[:sizes[i]], c_d if i == level else None, wave, mode=mode)
+
+    # the reconstruction can be 1 sample longer than the signal
+    return x_r[:x.size]
+
 
 class AccelerationFilter:
     def __init__(self, continuous_wavelet='gaus1', power_band=None, power_peak_kw=None, power_std_height=True,
                  power_std_trim=0, reconstruction_method='moving average', lowpass_order=4, lowpass_cutoff=5, 
-                 window=0.25, discrete_wavelet='dmey', extension_mode='constant', reconstruction_level=1):
+                 window=0.25, discrete_wavelet='dmey', extension_mode='constant', reconstruction_level=1,
+                 dtype='float64'):
         """
         Object for filtering and reconstructing raw acceleration data
 
@@ -66,6 +428,11 @@ class AccelerationFilter:
         reconstruction_level : int, optional
             Reconstruction level of the DWT processed signal. Default is 1. Ignored if reconstruction_method is
             'moving average'.
+        dtype : {'float64', 'float32'}, optional
+            Floating point precision of the acceleration magnitude during filtering, and of the filtered acceleration
+            magnitude that is returned. Default is 'float64'. 'float32' halves the memory moved while filtering, with
+            the filter arithmetic still done in double precision (except for `apply_batch_gpu`, which filters in
+            the precision of `dtype`).
         """
         if power_band is None:
             power_band = [0, 0.5]
@@ -96,6 +463,30 @@ class AccelerationFilter:
         self.ext_mode = extension_mode
         self.recon_level = reconstruction_level
 
+        self.dtype = np_dtype(dtype)
+        if self.dtype not in (float32, float64):
+            raise ValueError('dtype must be either "float64" or "float32".')
+
+        # work arrays re-used between calls to apply
+        self._buf = {}
+
+    @staticmethod
+    def _check_accel(accel):
+        """
+        Check that acceleration is a (N, 3) array, as the magnitude kernels require.
+        """
+        if accel.ndim != 2 or accel.shape[1] != 3:
+            raise ValueError(f'Acceleration must be a (N, 3) array, not {accel.shape}.')
+
+    def _get_buffer(self, name, n):
+        """
+        Get a (n, ) work array, re-using the memory from previous calls when it is large enough.
+        """
+        buf = self._buf.get(name)
+        if buf is None or buf.size < n:
+            buf = self._buf[name] = empty(n, self.dtype)
+        return buf[:n]
+
     def apply(self, accel, fs):
         """
         Apply the desired filtering to the provided signal.
@@ -120,33 +511,184 @@ class AccelerationFilter:
         power_peaks : numpy.ndarray
             Indices of the peaks detected in the power signal.
         """
+        accel = ascontiguousarray(accel)
+        self._check_accel(accel)
+
+        # compute the acceleration magnitude and filter it in the same kernel
+        sos = _design_butter(self.lp_ord, self.lp_cut, fs)
+        ext = self._get_buffer('ext', accel.shape[0] + 2 * _sos_padlen(sos))
+        macc_f = _mag_sosfiltfilt_into(sos, accel, ext, empty(accel.shape[0], self.dtype))
+
+        return self._reconstruct(macc_f, fs)
+
+    def apply_soa(self, ax, ay, az, fs):
+        """
+        Apply the desired filtering to the provided signal, with each acceleration axis in a separate array.
+
+        This avoids the strided access of an (N, 3) array when the axes are already stored separately.
+
+        Parameters
+        ----------
+        ax : numpy.ndarray
+            (N, ) array of raw acceleration values for the first axis.
+        ay : numpy.ndarray
+            (N, ) array of raw acceleration values for the second axis.
+        az : numpy.ndarray
+            (N, ) array of raw acceleration values for the third axis.
+        fs : float, optional
+            Sampling frequency for the acceleration data.
+
+        Returns
+        -------
+        mag_acc_f : numpy.ndarray
+            (N, ) array of the filtered (low-pass only) acceleration magnitude.
+        mag_acc_r : numpy.ndarray
+            (N, ) array of the reconstructed acceleration magnitude. See `apply`.
+        power : numpy.ndarray
+            (N, ) array of the CWT power approximation in the band specified by `power_band`.
+        power_peaks : numpy.ndarray
+            Indices of the peaks detected in the power signal.
+        """
+        if not (ax.size == ay.size == az.size):
+            raise ValueError('ax, ay, and az must all have the same number of samples.')
+
         # compute the acceleration magnitude
-        macc = norm(accel, axis=1)
+        macc = _mag3_soa(ascontiguousarray(ax), ascontiguousarray(ay), ascontiguousarray(az),
+                         self._get_buffer('macc', ax.size))
+
+        return self._apply_mag(macc, fs)
 
+    def _apply_mag(self, macc, fs):
+        """
+        Filter and reconstruct the acceleration magnitude, and find the CWT power peaks. See `apply`.
+        """
         # setup the filter, and filter the acceleration magnitude
-        fc = butter(self.lp_ord, 2 * self.lp_cut / fs, btype='low')
-        macc_f = ascontiguousarray(filtfilt(fc[0], fc[1], macc))
+        sos = _design_butter(self.lp_ord, self.lp_cut, fs)
+        ext = self._get_buffer('ext', macc.size + 2 * _sos_padlen(sos))
+        macc_f = _sosfiltfilt_into(sos, macc, ext, empty(macc.size, self.dtype))
 
-        if self.method == 'dwt':
-            # deconstruct the filtered acceleration magnitude
-            coefs = pywt.wavedec(macc_f, self.dwave, mode=self.ext_mode)
-
-            # set all but the desired level of coefficients to be 0s
-            if (len(coefs) - self.recon_level) < 1:
-                warn(UserWarning(f'Chosen reconstruction level is too high, '
-                                 f'setting reconstruction level to {len(coefs) - 1}'))
-                ind = 1
-            else:
-                ind = len(coefs) - self.recon_level
+        return self._reconstruct(macc_f, fs)
+
+    def apply_batch(self, segments, fs):
+        """
+        Apply the desired filtering to multiple independent segments of acceleration, computing the acceleration
+        magnitude and low-pass filtering of all the segments in parallel.
+
+        Parameters
+        ----------
+        segments : list
+            List of (N_i, 3) arrays of raw acceleration values, for example one per day or per subject.
+        fs : float
+            Sampling frequency for the acceleration data, the same for all the segments.
+
+        Returns
+        -------
+        results : list
+            List of the results for each segment, in the same order as `segments`. Each result is a tuple of
+            (`mag_acc_f`, `mag_acc_r`, `power`, `power_peaks`), as returned by `apply`.
+        """
+        if len(segments) == 0:
+            return []
+
+        sos = _design_butter(self.lp_ord, self.lp_cut, fs)
+        pad = _sos_padlen(sos)
+
+        segments = [asarray(seg) for seg in segments]
+        for seg in segments:
+            self._check_accel(seg)
+
+        # flatten the segments into one contiguous array, indexed by the segment offsets
+        lengths = array([seg.shape[0] for seg in segments], dtype='int64')
+        if any(lengths <= pad):
+            raise ValueError(f'All segments must be longer than the filter padding length ({pad} samples).')
+        offsets = insert(cumsum(lengths), 0, 0)
+        accel = ascontiguousarray(concatenate(segments, axis=0), dtype=float64)
+
+        # the work array is sized for the whole batch, so it is not kept in the buffer pool used by `apply`
+        ext = empty(offsets[-1] + 2 * pad * lengths.size, self.dtype)
+        macc_f = _batch_mag_sosfiltfilt(sos, accel, offsets, ext, empty(offsets[-1], self.dtype))
+
+        return [self._reconstruct(macc_f[i1:i2], fs) for i1, i2 in zip(offsets[:-1], offsets[1:])]
+
+    def apply_batch_gpu(self, stacked_accel, lengths, fs):
+        """
+        Apply the desired filtering to multiple independent segments of acceleration, computing the acceleration
+        magnitude and low-pass filtering of all the segments on the GPU. Requires CuPy.
+
+        Parameters
+        ----------
+        stacked_accel : {numpy.ndarray, cupy.ndarray}
+            (M, N_max, 3) array of raw acceleration values for M segments, each padded at the end to the length of
+            the longest segment.
+        lengths : array_like
+            (M, ) array_like of the number of samples in each segment.
+        fs : float
+            Sampling frequency for the acceleration data, the same for all the segments.
+
+        Returns
+        -------
+        results : list
+            List of the results for each segment. Each result is a tuple of (`mag_acc_f`, `mag_acc_r`, `power`,
+            `power_peaks`), as returned by `apply`.
+
+        Notes
+        -----
+        Only the magnitude and low-pass filtering are done on the GPU, with one transfer of the filtered magnitude
+        back to the host. Reconstruction and CWT power peak detection are done on the CPU for each segment, as in
+        `apply_batch`. This is only worthwhile for large batches, such as many subjects or days.
+
+        Unlike the CPU methods, the filter arithmetic is done in the precision of `dtype`, so with 'float32' the
+        filtered magnitude will differ more from `apply` than the rounding of the result alone.
+        """
+        if stacked_accel.ndim != 3 or stacked_accel.shape[2] != 3:
+            raise ValueError('stacked_accel must be a (M, N_max, 3) array.')
+
+        sos = _design_butter(self.lp_ord, self.lp_cut, fs)
+        pad = _sos_padlen(sos)
 
-            for i in range(1, len(coefs)):
-                if i != ind:
-                    coefs[i][:] = 0
+        lengths = asarray(lengths, dtype='int64')
+        if lengths.ndim != 1 or lengths.size != stacked_accel.shape[0]:
+            raise ValueError('lengths must have one entry for each segment in stacked_accel.')
+        if lengths.max(initial=0) > stacked_accel.shape[1]:
+            raise ValueError('lengths cannot be longer than the stacked segments.')
+        if any(lengths <= pad):
+            raise ValueError(f'All segments must be longer than the filter padding length ({pad} samples).')
 
-            macc_r = pywt.waverec(coefs, self.dwave, mode=self.ext_mode)
+        try:
+            import cupy
+            from cupyx.scipy.signal import sosfiltfilt as cupy_sosfiltfilt
+        except ImportError:
+            raise ImportError('CuPy (with cupyx.scipy.signal) is required for apply_batch_gpu.')
+
+        mag_kernel = cupy.ElementwiseKernel('T x, T y, T z', 'T m', 'm = sqrt(x * x + y * y + z * z)',
+                                            'sit2standpy_mag3')
+
+        d_accel = cupy.asarray(stacked_accel, dtype=self.dtype)
+        d_macc = mag_kernel(d_accel[:, :, 0], d_accel[:, :, 1], d_accel[:, :, 2])
+
+        # filter segments of the same length together, so that the padding never enters the signal extension
+        d_sos = cupy.asarray(sos, dtype=self.dtype)
+        d_macc_f = cupy.zeros_like(d_macc)
+        for n in unique(lengths):
+            rows = cupy.asarray(flatnonzero(lengths == n))
+            d_macc_f[rows, :n] = cupy_sosfiltfilt(d_sos, d_macc[rows, :n], axis=-1)
+
+        macc_f = cupy.asnumpy(d_macc_f)
+
+        return [self._reconstruct(macc_f[i, :n], fs) for i, n in enumerate(lengths)]
+
+    def _reconstruct(self, macc_f, fs):
+        """
+        Reconstruct the filtered acceleration magnitude, and find the CWT power peaks. See `apply`.
+        """
+        if self.method == 'dwt':
+            macc_r = _dwt_reconstruct(macc_f, self.dwave, self.ext_mode, self.recon_level)
         elif self.method == 'moving average':
             n_window = int(around(fs * self.window))  # compute the length in samples of the moving average
-            macc_r, _, _ = mov_stats(macc_f, n_window)  # compute the moving average
+            macc_r, _, _ = mov_stats_nb(macc_f, n_window)  # compute the moving average
+
+        # match the filtered acceleration dtype, which is a no-op for the default float64
+        macc_r = macc_r.astype(self.dtype, copy=False)
 
         # ---------------------------------------------------
         # CWT power peak detection
@@ -168,7 +710,99 @@ class AccelerationFilter:
 
         power_peaks, _ = find_peaks(power, **self.power_peak_kw)
 
-        return macc_f, macc_r[:macc_f.size], power, power_peaks
+        return macc_f, macc_r, power, power_peaks
+
+
+@lru_cache(maxsize=32)
+def _resolve_conv_kw(time_units, conv_kw_items):
+    """
+    Merge the time units into the key-word arguments for timestamp conversion. Results are cached, and the returned
+    dictionary is shared between calls, so it should not be modified.
+
+    Parameters
+    ----------
+    time_units : {None, str}
+        Time units, which override the "unit" in `conv_kw_items`.
+    conv_kw_items : {None, frozenset}
+        Items of the conversion key-word arguments dictionary.
+
+    Returns
+    -------
+    conv_kw : dict
+        Key-word arguments for the timestamp conversion.
+    """
+    if conv_kw_items is None:
+        if time_units is None:
+            raise ValueError('Either (time_units) must be defined, or "unit" must be a key of (conv_kw).')
+        return {'unit': time_units}
+
+    conv_kw = dict(conv_kw_items)
+    if time_units is not None:
+        conv_kw['unit'] = time_units
+    return conv_kw
+
+
+def _time_of_day(t):
+    """
+    Convert a time of day (string or datetime.time) to a pandas.Timedelta since midnight, parsing strings in the same
+    way as pandas.DatetimeIndex.indexer_between_time. Returns None if `t` can't be parsed.
+    """
+    if not isinstance(t, time):
+        try:
+            t = time.fromisoformat(t)
+        except (ValueError, TypeError):
+            for fmt in _TIME_FORMATS:
+                try:
+                    t = datetime.strptime(t, fmt).time()
+                    break
+                except (ValueError, TypeError):
+                    continue
+            else:
+                return None
+    return Timedelta(hours=t.hour, minutes=t.minute, seconds=t.second, microseconds=t.microsecond)
+
+
+def _window_bounds(timestamps, hours):
+    """
+    Find the start and stop indices of each day's window of timestamps between the given hours.
+
+    Parameters
+    ----------
+    timestamps : pandas.DatetimeIndex
+        Timestamps to window.
+    hours : array_like
+        Length two array_like of the start and end times of day (inclusive).
+
+    Returns
+    -------
+    starts : array_like
+        Start index of each window.
+    stops : array_like
+        Stop index (exclusive) of each window.
+    """
+    t_start, t_stop = _time_of_day(hours[0]), _time_of_day(hours[1])
+
+    if t_start is not None and t_stop is not None and t_start <= t_stop and timestamps.size > 0 \
+            and timestamps.tz is None and timestamps.is_monotonic_increasing:
+        # sorted timestamps, so the window for each day can be found with a binary search
+        days = date_range(timestamps[0].floor('D'), timestamps[-1].floor('D'), freq='D')
+        starts = timestamps.searchsorted(days + t_start, side='left')
+        stops = timestamps.searchsorted(days + t_stop, side='right')
+
+        starts, stops = starts[stops > starts], stops[stops > starts]
+        if starts.size > 0:
+            # join windows that are consecutive in the index, as for indexer_between_time below
+            day_splits = flatnonzero(starts[1:] != stops[:-1])
+            return insert(starts[day_splits + 1], 0, starts[0]), append(stops[day_splits], stops[-1])
+    else:
+        hour_inds = timestamps.indexer_between_time(hours[0], hours[1])
+
+        # each day is a run of consecutive indices, so it can be sliced directly instead of gathering with the indices
+        if hour_inds.size > 0:
+            day_splits = flatnonzero(diff(hour_inds) != 1)
+            return insert(hour_inds[day_splits + 1], 0, hour_inds[0]), append(hour_inds[day_splits], hour_inds[-1]) + 1
+
+    return [0], [0]
 
 
 def process_timestamps(times, accel, time_units=None, conv_kw=None, window=False, hours=('08:00', '20:00')):
@@ -206,19 +840,32 @@ def process_timestamps(times, accel, time_units=None, conv_kw=None, window=False
         Sampling time in seconds.
     accel : {numpy.ndarray, pd.Series, dict}, optional
         Acceleration windowed the same way as the timestamps (dictionary of acceleration for each day), if `window` is
-        True. If `window` is False, then the acceleration is not returned.
+        True. Each day is a slice of `accel`, which for a numpy.ndarray is a view into the original array. If `window`
+        is False, then the acceleration is not returned.
     """
-    if conv_kw is not None:
-        if time_units is not None:
-            conv_kw['unit'] = time_units
-    else:
-        if time_units is not None:
-            conv_kw = {'unit': time_units}
+    try:
+        conv_kw = _resolve_conv_kw(time_units, None if conv_kw is None else frozenset(conv_kw.items()))
+    except TypeError:  # un-hashable key-word argument values, which can't be cached
+        conv_kw = _resolve_conv_kw.__wrapped__(time_units, conv_kw.items())
+
+    # convert numeric unix timestamps directly with numpy's datetime64, skipping the per-timestamp python conversion
+    if isinstance(times, ndarray) and times.dtype.kind in 'iuf' and conv_kw.get('unit') in _UNITS_PER_S:
+        if times.dtype.kind == 'f':
+            # round to microseconds, half up, the same as the utcfromtimestamp conversion below. The whole seconds
+            # are split off first so that the rounding of the fraction matches exactly. Always done in double
+            # precision, as float32 can't hold the microseconds (or even the seconds) of current unix times
+            secs = times.astype(float64) / _UNITS_PER_S[conv_kw['unit']]
+            finite = isfinite(secs)
+            secs = where(finite, secs, 0.0)  # non-finite timestamps are set to NaT below, instead of overflowing
+            whole = floor(secs)
+            times_us = (whole * 1e6).astype('int64') + floor((secs - whole) * 1e6 + 0.5).astype('int64')
+            times_us = times_us.astype('datetime64[us]')
+            times_us[~finite] = datetime64('NaT')
+            timestamps = DatetimeIndex(times_us.astype('datetime64[ns]'))
         else:
-            raise ValueError('Either (time_units) must be defined, or "unit" must be a key of (conv_kw).')
-
+            timestamps = DatetimeIndex(times.astype(f"datetime64[{conv_kw['unit']}]").astype('datetime64[ns]'))
     # convert using pandas
-    if 'unit' in conv_kw:
+    elif 'unit' in conv_kw:
         if conv_kw['unit'] == 'ms':
             timestamps = to_datetime([utcfromtimestamp(t).replace(tzinfo=None) for t in times / 1e3])
         elif conv_kw['unit'] == 'us':
@@ -230,22 +877,23 @@ def process_timestamps(times, accel, time_units=None, conv_kw=None, window=False
     else:
         timestamps = to_datetime(times, **conv_kw)
 
-    # find the sampling time
-    dt = mean(diff(timestamps[:100])) / timedelta64(1, 's')  # convert to seconds
+    # find the sampling time. The mean of the differences is just the total elapsed time over the number of samples
+    ts_ = asarray(timestamps[:100])
+    if ts_.size < 2:
+        dt = nan  # no differences to take the sampling time from
+    else:
+        dt = (ts_[-1] - ts_[0]) / timedelta64(1, 's') / (ts_.size - 1)  # convert to seconds
 
     # windowing
     if window:
-        hour_inds = timestamps.indexer_between_time(hours[0], hours[1])
-
-        day_splits = argwhere(diff(hour_inds) > 1) + 1
-        day_splits = append(insert(day_splits, 0, 0), hour_inds.size)
+        starts, stops = _window_bounds(timestamps, hours)
 
         timestamps_ = {}
         accel_ = {}
 
-        for i in range(len(day_splits) - 1):
-            timestamps_[f'Day {i + 1}'] = timestamps[hour_inds][day_splits[i]: day_splits[i + 1]]
-            accel_[f'Day {i + 1}'] = accel[hour_inds][day_splits[i]: day_splits[i + 1]]
+        for i, (start, stop) in enumerate(zip(starts, stops)):
+            timestamps_[f'Day {i + 1}'] = timestamps[start:stop]
+            accel_[f'Day {i + 1}'] = accel[start:stop]
 
         return timestamps_, dt, accel_
     else:
@@ -1,6 +1,45 @@
 import pytest
-from numpy import isclose, allclose
-from sit2standpy.processing import AccelerationFilter, process_timestamps
+import warnings
+from numpy import isclose, allclose, random, empty, zeros, float32, arange, nan, inf, isfinite, mean, diff, \
+    timedelta64, isnan
+import pywt
+from pandas import date_range, to_datetime
+from udatetime import utcfromtimestamp
+from datetime import time as dt_time
+from numpy.linalg import norm
+from scipy.signal import butter, sosfiltfilt
+from sit2standpy.processing import AccelerationFilter, process_timestamps, sosfiltfilt_nb, _design_butter, \
+    _window_bounds, _mag_sosfiltfilt_into, _sos_padlen
+
+
+def test_design_butter():
+    sos = _design_butter(4, 5, 128.0)
+
+    assert sos is _design_butter(4, 5, 128.0)
+    assert not sos.flags.writeable
+    assert allclose(sos, butter(4, 2 * 5 / 128.0, btype='low', output='sos'))
+
+
+def test_mag_sosfiltfilt_into(raw_accel):
+    sos = butter(4, 0.1, btype='low', output='sos')
+    n = raw_accel.shape[0]
+    out = _mag_sosfiltfilt_into(sos, raw_accel, empty(n + 2 * _sos_padlen(sos)), empty(n))
+
+    assert allclose(out, sosfiltfilt(sos, norm(raw_accel, axis=1)))
+
+
+@pytest.mark.parametrize(('order', 'cutoff'), ((4, 0.1), (3, 0.25), (8, 0.05)))
+def test_sosfiltfilt_nb(order, cutoff):
+    x = random.rand(1000)
+    sos = butter(order, cutoff, btype='low', output='sos')
+
+    assert allclose(sosfiltfilt_nb(sos, x), sosfiltfilt(sos, x))
+
+
+def test_sosfiltfilt_nb_short_signal():
+    sos = butter(4, 0.1, btype='low', output='sos')
+    with pytest.raises(ValueError) as e_info:
+        sosfiltfilt_nb(sos, random.rand(10))
 
 
 class TestAccelerationFilter:
@@ -34,6 +73,117 @@ class TestAccelerationFilter:
         assert allclose(power_rm, pwr)
         assert allclose(power_peaks_rm, pwr_pk)
 
+    def test_soa(self, raw_accel):
+        af = AccelerationFilter(reconstruction_method='moving average')
+
+        res = af.apply(raw_accel, 128)
+        res_soa = af.apply_soa(raw_accel[:, 0], raw_accel[:, 1], raw_accel[:, 2], 128)
+
+        assert all([allclose(i, j) for i, j in zip(res, res_soa)])
+
+    @pytest.mark.parametrize('cols', (2, 4))
+    def test_accel_shape_error(self, raw_accel, cols):
+        af = AccelerationFilter()
+        accel = random.rand(raw_accel.shape[0], cols)
+        with pytest.raises(ValueError) as e_info:
+            af.apply(accel, 128)
+        with pytest.raises(ValueError) as e_info:
+            af.apply_batch([raw_accel, accel], 128)
+
+    def test_soa_length_error(self, raw_accel):
+        af = AccelerationFilter()
+        with pytest.raises(ValueError) as e_info:
+            af.apply_soa(raw_accel[:, 0], raw_accel[:5000, 1], raw_accel[:, 2], 128)
+
+    def test_repeated_apply(self, raw_accel):
+        af = AccelerationFilter(reconstruction_method='moving average')
+
+        f_acc1, rm_acc1, _, _ = af.apply(raw_accel, 128)
+        f_acc2, rm_acc2, _, _ = af.apply(raw_accel[:5000], 128)  # re-uses the buffers from the first call
+        f_acc3, rm_acc3, _, _ = af.apply(raw_accel, 128)
+
+        assert f_acc1 is not f_acc3
+        assert allclose(f_acc1, f_acc3)
+        assert allclose(rm_acc1, rm_acc3)
+        assert f_acc2.size == 5000
+
+    @pytest.mark.parametrize('method', ('moving average', 'dwt'))
+    def test_batch(self, raw_accel, method):
+        af = AccelerationFilter(reconstruction_method=method)
+        segments = [raw_accel[:4000], raw_accel[4000:9000], raw_accel[9000:]]
+
+        res_batch = af.apply_batch(segments, 128)
+
+        assert len(res_batch) == 3
+        for seg, res in zip(segments, res_batch):
+            assert all([allclose(i, j) for i, j in zip(af.apply(seg, 128), res)])
+
+    def test_batch_empty(self):
+        af = AccelerationFilter()
+
+        assert af.apply_batch([], 128) == []
+
+    def test_batch_buffers(self, raw_accel):
+        af = AccelerationFilter()
+        af.apply(raw_accel[:4000], 128)
+        ext_size = af._buf['ext'].size
+
+        af.apply_batch([raw_accel[:4000], raw_accel[4000:9000], raw_accel[9000:]], 128)
+
+        assert af._buf['ext'].size == ext_size
+
+    def test_batch_gpu(self, raw_accel):
+        pytest.importorskip('cupy')
+        af = AccelerationFilter(reconstruction_method='moving average')
+        lengths = [4000, 5000, 4000]
+
+        stacked = zeros((3, 5000, 3))
+        stacked[0, :4000] = raw_accel[:4000]
+        stacked[1] = raw_accel[4000:9000]
+        stacked[2, :4000] = raw_accel[-4000:]
+
+        res_gpu = af.apply_batch_gpu(stacked, lengths, 128)
+
+        for i, (n, res) in enumerate(zip(lengths, res_gpu)):
+            assert all([allclose(j, k) for j, k in zip(af.apply(stacked[i, :n], 128), res)])
+
+    @pytest.mark.parametrize(('shape', 'lengths'), (((3, 5000), [4000, 5000, 4000]),
+                                                    ((3, 5000, 3), [4000, 5000]),
+                                                    ((3, 5000, 3), [4000, 5001, 4000])))
+    def test_batch_gpu_shape_error(self, shape, lengths):
+        af = AccelerationFilter()
+        with pytest.raises(ValueError) as e_info:
+            af.apply_batch_gpu(zeros(shape), lengths, 128)
+
+    def test_batch_short_segment(self, raw_accel):
+        af = AccelerationFilter()
+        with pytest.raises(ValueError) as e_info:
+            af.apply_batch([raw_accel[:1000], raw_accel[:10]], 128)
+
+    def test_float32(self, raw_accel, filt_accel_rm, rm_accel_rm):
+        af = AccelerationFilter(reconstruction_method='moving average', dtype='float32')
+
+        f_acc, rm_acc, _, _ = af.apply(raw_accel, 128)
+
+        assert f_acc.dtype == float32
+        assert allclose(filt_accel_rm, f_acc, rtol=1e-4)
+        assert allclose(rm_accel_rm, rm_acc, rtol=1e-4)
+
+    @pytest.mark.parametrize(('method', 'dtype', 'n'), (('moving average', 'float64', 11650),
+                                                     ('moving average', 'float32', 11650),
+                                                     ('dwt', 'float64', 11649), ('dwt', 'float32', 11649)))
+    def test_output_shapes(self, raw_accel, method, dtype, n):
+        af = AccelerationFilter(reconstruction_method=method, dtype=dtype)
+
+        f_acc, rm_acc, pwr, _ = af.apply(raw_accel[:n], 128)
+
+        assert f_acc.shape == rm_acc.shape == pwr.shape == (n,)
+        assert f_acc.dtype == rm_acc.dtype
+
+    def test_dtype_error(self):
+        with pytest.raises(ValueError) as e_info:
+            AccelerationFilter(dtype='int64')
+
     def test_dwt(self, raw_accel, filt_accel_dwt, rec_accel_dwt, power_dwt, power_peaks_dwt):
         af = AccelerationFilter(continuous_wavelet='gaus1', power_band=[0, 0.5], power_peak_kw={'distance': 128},
                                 power_std_height=True, reconstruction_method='dwt', lowpass_order=4,
@@ -47,12 +197,36 @@ class TestAccelerationFilter:
         assert allclose(power_dwt, pwr)
         assert allclose(power_peaks_dwt, pwr_pk)
 
+    @pytest.mark.parametrize(('wavelet', 'level'), (('dmey', 2), ('dmey', 7), ('db4', 3), (pywt.Wavelet('db4'), 3)))
+    def test_dwt_levels(self, raw_accel, wavelet, level):
+        af = AccelerationFilter(reconstruction_method='dwt', discrete_wavelet=wavelet, reconstruction_level=level)
+
+        f_acc, rm_acc, _, _ = af.apply(raw_accel, 128)
+
+        # full decomposition and reconstruction, zeroing all but the approximation and chosen detail level
+        coefs = pywt.wavedec(f_acc, wavelet, mode='constant')
+        for i in range(1, len(coefs)):
+            if i != len(coefs) - level:
+                coefs[i][:] = 0
+        rec = pywt.waverec(coefs, wavelet, mode='constant')
+
+        assert allclose(rec[:f_acc.size], rm_acc)
+
 
 class TestProcessTimestamps:
     def test_errors(self, time, raw_accel):
         with pytest.raises(ValueError) as e_info:
             process_timestamps(time, raw_accel)
 
+    def test_conv_kw(self, timestamps_time_accel):
+        conv_kw = {'unit': 's'}
+        timestamps, dt = process_timestamps(timestamps_time_accel[1], timestamps_time_accel[2], time_units='ns',
+                                            conv_kw=conv_kw)
+
+        assert conv_kw == {'unit': 's'}  # the input is not modified
+        assert all(timestamps == timestamps_time_accel[0])
+        assert isclose(dt, 0.05)
+
     def test_window(self, overnight_time_accel, windowed_timestamps):
         timestamps, dt, accel = process_timestamps(overnight_time_accel[0], overnight_time_accel[1], time_units='ns',
                                                    conv_kw={}, window=True, hours=('08:00', '20:00'))
@@ -62,6 +236,29 @@ class TestProcessTimestamps:
         assert all([key in accel for key in ['Day 1', 'Day 2']])
         assert isclose(dt, 3600.0)
 
+    def test_window_accel(self, overnight_time_accel):
+        _, _, accel = process_timestamps(overnight_time_accel[0], overnight_time_accel[1], time_units='ns',
+                                         window=True, hours=('08:00', '20:00'))
+
+        assert allclose(accel['Day 1'], overnight_time_accel[1][:5])
+        assert allclose(accel['Day 2'], overnight_time_accel[1][16:])
+
+    @pytest.mark.parametrize('hours', (('08:00', '20:00'), ('00:00', '23:59:59'), ('13:30', '13:45'),
+                                       ('20:00', '08:00'), ('0800', '2000'), ('080000', '200000'),
+                                       ('0830PM', '1100PM'), ('08:30AM', '11:00PM'), ('08:00:00', '20:00:00'),
+                                       (dt_time(8), dt_time(20))))
+    def test_window_bounds(self, hours):
+        ts = date_range(start='2019-10-10 16:00', end='2019-10-13 12:00', freq='7min')
+        ts = ts.delete(slice(100, 250))  # gap in the data
+
+        starts, stops = _window_bounds(ts, hours)
+        # index based windowing, which the sorted timestamps fast path should match
+        inds = ts.indexer_between_time(hours[0], hours[1])
+        splits = [0] + [i + 1 for i in range(inds.size - 1) if inds[i + 1] - inds[i] > 1] + [inds.size]
+
+        assert list(starts) == [inds[i] for i in splits[:-1]]
+        assert list(stops) == [inds[i - 1] + 1 for i in splits[1:]]
+
     def test_no_window(self, timestamps_time_accel):
         timestamps, dt = process_timestamps(timestamps_time_accel[1], timestamps_time_accel[2], time_units='ns',
                                             window=False)
@@ -69,3 +266,33 @@ class TestProcessTimestamps:
         assert all(timestamps == timestamps_time_accel[0])
         assert isclose(dt, 0.05)
 
+    @pytest.mark.parametrize(('units', 'factor', 'dtype'), (('s', 1, 'float64'), ('ms', 1e3, 'float64'),
+                                                         ('us', 1e6, 'float64'), ('ns', 1e9, 'float64'),
+                                                         ('s', 1, 'float32'), ('ms', 1e3, 'float32')))
+    def test_float_unix_time(self, units, factor, dtype):
+        # 128Hz sampling puts every other sample exactly on a half microsecond
+        times = ((1568054270.0 + arange(10000) / 128) * factor).astype(dtype)
+        timestamps, dt = process_timestamps(times, None, time_units=units)
+
+        # per-timestamp python datetime conversion of the exact (double precision) values of the timestamps
+        expected = to_datetime([utcfromtimestamp(t).replace(tzinfo=None) for t in times.astype('float64') / factor])
+
+        assert all(timestamps == expected)
+        assert isclose(dt, mean(diff(expected[:100])) / timedelta64(1, 's'))
+
+    @pytest.mark.parametrize('n', (0, 1))
+    def test_too_few_times(self, n):
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            timestamps, dt = process_timestamps(1568054270.0 + arange(n, dtype='float64'), None, time_units='s')
+
+        assert timestamps.size == n
+        assert isnan(dt)
+
+    def test_non_finite_unix_time(self):
+        times = 1568054270.0 + arange(10, dtype='float64')
+        times[[2, 5, 7]] = [nan, inf, -inf]
+        timestamps, _ = process_timestamps(times, None, time_units='s')
+
+        assert all(timestamps.isna() == ~isfinite(times))
+        assert all(timestamps[isfinite(times)] == to_datetime(times[isfinite(times)], unit='s'))
@@ -1,7 +1,7 @@
 import pytest
 from pandas import to_datetime
-from numpy import isclose, allclose, array, ones
-from sit2standpy.utility import Transition, mov_stats
+from numpy import isclose, allclose, array, ones, random, inf, nan
+from sit2standpy.utility import Transition, mov_stats, mov_stats_nb
 
 
 @pytest.mark.parametrize(('start_time', 'end_time', 'ttype', 'long_type', 'duration'), (
@@ -51,3 +51,30 @@ def test_mov_stats(x, win, mn, sd, pad):
     assert allclose(mean, mn)
     assert allclose(st_dev, sd)
     assert isclose(n_pad, pad)
+
+
+@pytest.mark.parametrize('win', (1, 2, 5, 32, 33))
+def test_mov_stats_nb(win):
+    x = 9.81 + random.rand(1000)
+    mean, st_dev, n_pad = mov_stats(x, win)
+    mean_nb, st_dev_nb, n_pad_nb = mov_stats_nb(x, win)
+
+    assert allclose(mean_nb, mean)
+    assert allclose(st_dev_nb, st_dev)
+    assert n_pad_nb == n_pad
+
+
+@pytest.mark.parametrize('bad', ((nan,), (inf,), (-inf,), (inf, -inf), (nan, nan)))
+def test_mov_stats_nb_non_finite(bad):
+    x = 9.81 + random.rand(100)
+    x[[10, 12][:len(bad)]] = bad  # both in the same windows when there are 2
+    mean, st_dev, _ = mov_stats(x, 5)
+    mean_nb, st_dev_nb, _ = mov_stats_nb(x, 5)
+
+    assert allclose(mean_nb, mean, equal_nan=True)
+    assert allclose(st_dev_nb, st_dev, equal_nan=True)
+
+
+def test_mov_stats_nb_window_error():
+    with pytest.raises(ValueError) as e_info:
+        mov_stats_nb(random.rand(20), 32)
@@ -4,8 +4,10 @@ Common methods for both acceleration only and imu-based postural transition dete
 Lukas Adamowicz
 June 2019
 """
-from numpy import ndarray, zeros, mean, std, ceil, around, gradient, abs, where, diff, insert, append
+from numpy import ndarray, zeros, mean, std, ceil, around, gradient, abs, where, diff, insert, append, sqrt, \
+    isnan, isfinite, inf, nan
 from numpy.lib import stride_tricks
+from numba import njit
 
 
 class Transition:
@@ -144,6 +146,96 @@ def mov_stats(seq, window):
     return m_mn, m_st, pad
 
 
+@njit(cache=True)
+def _mov_stats_update(state, v, k, sign):
+    """
+    Add (sign=1) or remove (sign=-1) a sample from the running window sums in `state`, which are
+    [sum, sum of squares, # NaN, # +inf, # -inf]. Non-finite samples are counted instead of summed.
+    """
+    if isnan(v):
+        state[2] += sign
+    elif v == inf:
+        state[3] += sign
+    elif v == -inf:
+        state[4] += sign
+    else:
+        state[0] += sign * (v - k)
+        state[1] += sign * (v - k)**2
+
+
+@njit(cache=True)
+def mov_stats_nb(x, w):
+    """
+    Compute the centered moving average and standard deviation with running sums, compiled with Numba.
+
+    Produces the same output as `mov_stats` (to within floating point error), but in O(N) time instead of
+    O(N * window), by updating the window sums as samples enter and leave the window. As with `mov_stats`, non-finite
+    values only affect the windows that contain them.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Data to take the moving average and standard deviation on.
+    w : int
+        Window size for the moving average/standard deviation.
+
+    Returns
+    -------
+    m_mn : numpy.ndarray
+        Moving average
+    m_st : numpy.ndarray
+        Moving standard deviation
+    pad : int
+        Padding at beginning of the moving average and standard deviation
+    """
+    m_mn = zeros(x.size)
+    m_st = zeros(x.size)
+
+    if w < 2:
+        w = 2
+    if w > x.size:
+        raise ValueError('Window size cannot be larger than the number of samples.')
+
+    pad = (w + 1) // 2
+    n = x.size - w + 1
+
+    # sums are of the data shifted by the first finite value, which limits cancellation in the variance
+    k = 0.0
+    for i in range(x.size):
+        if isfinite(x[i]):
+            k = x[i]
+            break
+
+    state = zeros(5)
+    for i in range(w - 1):
+        _mov_stats_update(state, x[i], k, 1.0)
+
+    for i in range(n):
+        _mov_stats_update(state, x[i + w - 1], k, 1.0)
+        if i > 0:
+            _mov_stats_update(state, x[i - 1], k, -1.0)
+
+        s1, s2, n_nan, n_pinf, n_minf = state[0], state[1], state[2], state[3], state[4]
+        if n_nan > 0 or (n_pinf > 0 and n_minf > 0):
+            m_mn[pad + i] = nan
+        elif n_pinf > 0:
+            m_mn[pad + i] = inf
+        elif n_minf > 0:
+            m_mn[pad + i] = -inf
+        else:
+            m_mn[pad + i] = k + s1 / w
+
+        if n_nan > 0 or n_pinf > 0 or n_minf > 0:
+            m_st[pad + i] = nan
+        else:
+            m_st[pad + i] = sqrt(max((s2 - s1**2 / w) / (w - 1), 0.0))
+
+    # fill the ends in the same way as mov_stats
+    m_mn[:pad], m_mn[pad + n:] = m_mn[pad], m_mn[-pad - 1]
+    m_st[:pad], m_st[pad + n:] = m_st[pad], m_st[-pad - 1]
+    return m_mn, m_st, pad
+
+
 def get_stillness(filt_accel, dt, window, gravity, thresholds):
     """
     Stillness determination based on filtered acceleration magnitude and jerk magnitude